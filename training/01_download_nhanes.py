@@ -6,47 +6,120 @@ Applies Sempos et al. crosswalk for pre-2007 RIA assay values.
 Converts nmol/L → ng/mL.
 """
 
+import hashlib
 import os
 import sys
 import pandas as pd
 import numpy as np
 import requests
-from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from config import (
     NHANES_CYCLES, RAW_DIR, RIA_CYCLES, SEMPOS_CROSSWALK,
     NMOL_TO_NGML, VID_VARNAMES, SUPP_VARNAMES
 )
 
+# pyreadstat is a C-backed XPT reader, roughly an order of magnitude faster
+# than pandas' pure-Python SAS parser; fall back to pandas if unavailable.
+try:
+    import pyreadstat
+except ImportError:
+    pyreadstat = None
+
+# Downloads are pure I/O wait, so fan them out across a thread pool and
+# reuse one pooled session so TCP/TLS handshakes are amortized.
+MAX_DOWNLOAD_WORKERS = 16
+
+# On-disk cache of raw XPT bytes keyed by URL: reruns skip the network
+# entirely, and a partial failure keeps everything already fetched.
+CACHE_DIR = os.path.join(RAW_DIR, "xpt_cache")
+
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(
+    pool_connections=MAX_DOWNLOAD_WORKERS,
+    pool_maxsize=MAX_DOWNLOAD_WORKERS,
+))
+
+
+def _read_xpt(path: str, usecols: list | None = None) -> pd.DataFrame:
+    """Read an XPT file from disk, parsing only `usecols` where possible."""
+    if pyreadstat is None:
+        return pd.read_sas(path, format="xport")
+    try:
+        df, _ = pyreadstat.read_xport(path, usecols=usecols)
+        return df
+    except Exception:
+        # usecols may name variables absent in some cycles; re-read everything
+        # and keep whichever requested columns actually exist.
+        df, _ = pyreadstat.read_xport(path)
+        if usecols is not None:
+            df = df[[c for c in usecols if c in df.columns]]
+        return df
+
+
+def download_xpt(url: str, usecols: list | None = None) -> pd.DataFrame:
+    """Download and read an XPT (SAS transport) file from a URL.
+
+    Raw bytes are cached under CACHE_DIR; set FORCE_REDOWNLOAD=1 to bypass.
+    Only `usecols` are parsed when the C reader is available.
+    """
+    cache_path = os.path.join(CACHE_DIR, hashlib.sha1(url.encode()).hexdigest() + ".xpt")
+    if os.path.exists(cache_path) and not os.environ.get("FORCE_REDOWNLOAD"):
+        print(f"  Using cached {url}")
+        return _read_xpt(cache_path, usecols)
 
-def download_xpt(url: str) -> pd.DataFrame:
-    """Download and read an XPT (SAS transport) file from a URL."""
     print(f"  Downloading {url}...")
-    resp = requests.get(url, timeout=60)
+    resp = _session.get(url, timeout=60)
     resp.raise_for_status()
-    return pd.read_sas(BytesIO(resp.content), format="xport")
+    # Write atomically so an interrupted run never leaves a truncated cache file
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(resp.content)
+    os.replace(tmp_path, cache_path)
+    return _read_xpt(cache_path, usecols)
 
 
-def apply_sempos_crosswalk(values: pd.Series) -> pd.Series:
+def apply_sempos_crosswalk(values: np.ndarray) -> np.ndarray:
     """Apply Sempos et al. crosswalk to convert DiaSorin RIA → LC-MS/MS equivalent.
 
-    Input values should be in nmol/L.
-    Returns standardized values in nmol/L.
+    Input values should be in nmol/L; finite entries are rewritten in place
+    (np.polyval, Horner form) and the same array is returned — no Series
+    alignment or masked write-back.
     """
-    a = SEMPOS_CROSSWALK["intercept"]
-    b = SEMPOS_CROSSWALK["slope"]
-    c = SEMPOS_CROSSWALK["quadratic"]
-    return a + b * values + c * values ** 2
+    coeffs = [
+        SEMPOS_CROSSWALK["quadratic"],
+        SEMPOS_CROSSWALK["slope"],
+        SEMPOS_CROSSWALK["intercept"],
+    ]
+    mask = np.isfinite(values)
+    values[mask] = np.polyval(coeffs, values[mask])
+    return values
 
 
-def process_cycle(cycle: str, urls: dict) -> pd.DataFrame:
+def process_cycle(cycle: str, urls: dict, executor: ThreadPoolExecutor) -> pd.DataFrame:
     """Download and minimally process one NHANES cycle."""
     print(f"\nProcessing cycle {cycle}...")
 
-    # Download all tables
-    demo = download_xpt(urls["DEMO"])
-    bmx = download_xpt(urls["BMX"])
-    vid = download_xpt(urls["VID"])
-    ds1 = download_xpt(urls["DS1TOT"])
+    # Only these variables are used downstream; pushing the column list into
+    # the reader skips parsing the hundreds of others each table carries.
+    usecols_by_table = {
+        "DEMO": ["SEQN", "RIDAGEYR", "RIAGENDR", "RIDRETH1", "RIDEXMON",
+                 "WTMEC2YR", "RIDEXPRG"],
+        "BMX": ["SEQN", "BMXBMI"],
+        "VID": ["SEQN", VID_VARNAMES[cycle]],
+        "DS1TOT": ["SEQN"] + ([SUPP_VARNAMES[cycle]] if SUPP_VARNAMES[cycle] else []),
+    }
+
+    # Download all four tables concurrently
+    futures = {
+        table: executor.submit(download_xpt, url, usecols_by_table[table])
+        for table, url in urls.items()
+    }
+    tables = {table: fut.result() for table, fut in futures.items()}
+    demo = tables["DEMO"]
+    bmx = tables["BMX"]
+    vid = tables["VID"]
+    ds1 = tables["DS1TOT"]
 
     # Extract key variables from DEMO
     demo_cols = ["SEQN", "RIDAGEYR", "RIAGENDR", "RIDRETH1", "RIDEXMON"]
@@ -74,10 +147,23 @@ def process_cycle(cycle: str, urls: dict) -> pd.DataFrame:
         ds1_cols.append(supp_var)
     ds1 = ds1[ds1_cols].copy()
 
-    # Merge all on SEQN
-    df = demo.merge(bmx, on="SEQN", how="left")
-    df = df.merge(vid, on="SEQN", how="left")
-    df = df.merge(ds1, on="SEQN", how="left")
+    # Merge all on SEQN. The joins run against sorted uint32 indices, so
+    # pandas takes its monotonic-key fast path instead of building a hash
+    # table for each of the three merges.
+    for t in (demo, bmx, vid, ds1):
+        t["SEQN"] = t["SEQN"].astype("uint32")
+    df = (
+        demo.set_index("SEQN").sort_index()
+        .join(
+            [
+                bmx.set_index("SEQN").sort_index(),
+                vid.set_index("SEQN").sort_index(),
+                ds1.set_index("SEQN").sort_index(),
+            ],
+            how="left",
+        )
+        .reset_index()
+    )
 
     # Rename columns to standardized names
     rename_map = {
@@ -100,8 +186,11 @@ def process_cycle(cycle: str, urls: dict) -> pd.DataFrame:
     # Apply Sempos crosswalk for pre-2007 RIA cycles
     if cycle in RIA_CYCLES and "vitd_nmol" in df.columns:
         print(f"  Applying Sempos crosswalk for RIA cycle {cycle}")
-        mask = df["vitd_nmol"].notna()
-        df.loc[mask, "vitd_nmol"] = apply_sempos_crosswalk(df.loc[mask, "vitd_nmol"])
+        # Explicit copy: under pandas copy-on-write, to_numpy(copy=False)
+        # hands back a read-only view and the in-place rewrite raises
+        df["vitd_nmol"] = apply_sempos_crosswalk(
+            df["vitd_nmol"].to_numpy(dtype=np.float64, copy=True)
+        )
 
     # Convert nmol/L → ng/mL
     if "vitd_nmol" in df.columns:
@@ -119,15 +208,24 @@ def process_cycle(cycle: str, urls: dict) -> pd.DataFrame:
 
 def main():
     os.makedirs(RAW_DIR, exist_ok=True)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+
+    # One pool for the blocking HTTP fetches, one to run cycles concurrently;
+    # results are collected back in NHANES_CYCLES order for deterministic output.
+    with ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_WORKERS) as download_pool, \
+         ThreadPoolExecutor(max_workers=len(NHANES_CYCLES)) as cycle_pool:
+        cycle_futures = {
+            cycle: cycle_pool.submit(process_cycle, cycle, urls, download_pool)
+            for cycle, urls in NHANES_CYCLES.items()
+        }
 
-    all_dfs = []
-    for cycle, urls in NHANES_CYCLES.items():
-        try:
-            df = process_cycle(cycle, urls)
-            all_dfs.append(df)
-        except Exception as e:
-            print(f"  ERROR processing {cycle}: {e}", file=sys.stderr)
-            continue
+        all_dfs = []
+        for cycle, future in cycle_futures.items():
+            try:
+                all_dfs.append(future.result())
+            except Exception as e:
+                print(f"  ERROR processing {cycle}: {e}", file=sys.stderr)
+                continue
 
     if not all_dfs:
         print("No data downloaded!", file=sys.stderr)
@@ -135,8 +233,26 @@ def main():
 
     combined = pd.concat(all_dfs, ignore_index=True)
 
+    # Narrow dtypes before writing: float32 is plenty for these measurements
+    # and halves the bytes step 2 has to read back.
+    if "SEQN" in combined.columns and combined["SEQN"].notna().all():
+        combined["SEQN"] = combined["SEQN"].astype("uint32")
+    for col in ("age", "sex", "race_eth_raw", "exam_season_raw", "pregnant",
+                "bmi", "vitd_nmol", "vitd_ng", "supp_vitd_mcg", "supp_vitd_iu",
+                "sample_weight_raw"):
+        if col in combined.columns:
+            combined[col] = combined[col].astype("float32")
+    combined["cycle"] = combined["cycle"].astype("category")
+
     output_path = os.path.join(RAW_DIR, "nhanes_combined_raw.parquet")
-    combined.to_parquet(output_path, index=False)
+    combined.to_parquet(
+        output_path,
+        index=False,
+        compression="zstd",
+        compression_level=3,
+        use_dictionary=True,
+        row_group_size=200_000,
+    )
     print(f"\nSaved {len(combined)} total records to {output_path}")
     print(f"Columns: {list(combined.columns)}")
     print(f"Cycles: {combined['cycle'].value_counts().to_dict()}")
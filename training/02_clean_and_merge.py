@@ -9,12 +9,25 @@ import os
 import sys
 import pandas as pd
 import numpy as np
+import pyarrow.parquet as pq
 from config import (
     RAW_DIR, PROCESSED_DIR, RACE_ETH_MAP, SEX_MAP, SEASON_MAP,
     SUPPLEMENT_BINS, SUPPLEMENT_LABELS, FEATURE_NAMES, TARGET, WEIGHT_COLUMN
 )
 
 
+_SUPPLEMENT_EDGES = np.asarray(SUPPLEMENT_BINS, dtype=np.float32)
+# Sanity-check the searchsorted encoding against the documented bin semantics
+# ([0,1) none, [1,400) trace, [400,1000) low, [1000,2000) moderate, 2000+ high)
+assert list(
+    np.clip(
+        np.searchsorted(_SUPPLEMENT_EDGES, np.float32([0, 1, 400, 1000, 2000, 5000]), side="right") - 1,
+        0,
+        len(SUPPLEMENT_LABELS) - 1,
+    )
+) == [0, 1, 2, 3, 4, 4]
+
+
 def clean_data(df: pd.DataFrame) -> pd.DataFrame:
     """Apply inclusion/exclusion criteria and clean data."""
     n_start = len(df)
@@ -52,35 +65,45 @@ def clean_data(df: pd.DataFrame) -> pd.DataFrame:
     return df
 
 
+def _lut_encode(series: pd.Series, mapping: dict) -> np.ndarray:
+    """Map small positive integer codes through a NumPy lookup table.
+
+    Returns int8 codes with -1 for missing/unmapped values — a gather
+    instead of the hashed .map() + object-dtype astype(int) round trip.
+    """
+    lut = np.full(int(max(mapping)) + 2, -1, dtype=np.int8)
+    for k, v in mapping.items():
+        lut[int(k)] = v
+    raw = series.fillna(0).to_numpy(dtype=np.int16)
+    # Out-of-range codes land on lut[0], which is -1 (no mapping uses key 0)
+    return lut[np.clip(raw, 0, len(lut) - 1)]
+
+
 def encode_features(df: pd.DataFrame) -> pd.DataFrame:
     """Encode categorical features for model training."""
     # Race/ethnicity encoding
-    df["race_eth"] = df["race_eth_raw"].map(RACE_ETH_MAP)
-    n_missing = df["race_eth"].isna().sum()
+    race_codes = _lut_encode(df["race_eth_raw"], RACE_ETH_MAP)
+    n_missing = int((race_codes == -1).sum())
+    df["race_eth"] = race_codes
     if n_missing > 0:
         print(f"Warning: {n_missing} records with unmapped race_eth, dropping")
-        df = df[df["race_eth"].notna()].copy()
-    df["race_eth"] = df["race_eth"].astype(int)
+        df = df[df["race_eth"] != -1].copy()
 
     # Sex encoding
-    df["sex"] = df["sex"].map(SEX_MAP)
-    df = df[df["sex"].notna()].copy()
-    df["sex"] = df["sex"].astype(int)
+    df["sex"] = _lut_encode(df["sex"], SEX_MAP)
+    df = df[df["sex"] != -1].copy()
 
-    # Exam season encoding
-    df["exam_season"] = df["exam_season_raw"].map(SEASON_MAP)
-    # Fill missing season with winter (conservative)
-    df["exam_season"] = df["exam_season"].fillna(1).astype(int)
+    # Exam season encoding; fill missing season with winter (conservative)
+    season_codes = _lut_encode(df["exam_season_raw"], SEASON_MAP)
+    df["exam_season"] = np.where(season_codes == -1, 1, season_codes).astype(np.int8)
 
-    # Supplement category (ordinal from dose bins)
+    # Supplement category (ordinal from dose bins). np.searchsorted on the
+    # bin edges is a single binary search per row with no Categorical or
+    # IntervalIndex intermediates; equivalent to pd.cut with right=False.
     if "supp_vitd_iu" in df.columns:
-        df["supplement_cat"] = pd.cut(
-            df["supp_vitd_iu"].fillna(0),
-            bins=SUPPLEMENT_BINS,
-            labels=SUPPLEMENT_LABELS,
-            right=False,
-            include_lowest=True,
-        ).astype(int)
+        vals = df["supp_vitd_iu"].fillna(0).to_numpy(dtype=np.float32)
+        codes = np.searchsorted(_SUPPLEMENT_EDGES, vals, side="right") - 1
+        df["supplement_cat"] = np.clip(codes, 0, len(SUPPLEMENT_LABELS) - 1).astype(np.int8)
     else:
         df["supplement_cat"] = 0
 
@@ -111,7 +134,12 @@ def main():
         print("Run 01_download_nhanes.py first.", file=sys.stderr)
         sys.exit(1)
 
-    df = pd.read_parquet(input_path)
+    # Column pruning: only read the variables this step actually uses
+    # (skips e.g. vitd_nmol, which is kept in the raw file for provenance).
+    wanted = ["SEQN", "cycle", "age", "sex", "race_eth_raw", "exam_season_raw",
+              "pregnant", "bmi", "vitd_ng", "supp_vitd_iu", "sample_weight_raw"]
+    available = set(pq.read_schema(input_path).names)
+    df = pd.read_parquet(input_path, columns=[c for c in wanted if c in available])
     print(f"Loaded {len(df)} raw records")
 
     # Clean
@@ -126,6 +154,16 @@ def main():
     # Also keep raw vitd_ng for analysis
     final = df[keep_cols].copy()
 
+    # Downcast: all filters/encodings above guarantee these are non-missing,
+    # so the narrow integer types are safe and shrink the file substantially.
+    final["SEQN"] = final["SEQN"].astype("uint32")
+    final["age"] = final["age"].astype("uint8")
+    for col in ("sex", "race_eth", "exam_season", "supplement_cat"):
+        final[col] = final[col].astype("int8")
+    for col in ("bmi", TARGET, WEIGHT_COLUMN):
+        final[col] = final[col].astype("float32")
+    final["cycle"] = final["cycle"].astype("category")
+
     # Summary stats
     print(f"\n--- Final dataset ---")
     print(f"Records: {len(final)}")
@@ -138,7 +176,14 @@ def main():
     print(final["race_eth"].value_counts().sort_index())
 
     output_path = os.path.join(PROCESSED_DIR, "analytical_dataset.parquet")
-    final.to_parquet(output_path, index=False)
+    final.to_parquet(
+        output_path,
+        index=False,
+        compression="zstd",
+        compression_level=3,
+        use_dictionary=True,
+        row_group_size=200_000,
+    )
     print(f"\nSaved to {output_path}")
 
 
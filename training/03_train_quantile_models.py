@@ -6,6 +6,7 @@ Uses 5-fold CV hyperparameter search and NHANES sample weights.
 Exports random-split and temporal-holdout validation metadata.
 """
 
+import argparse
 import os
 import sys
 import json
@@ -15,18 +16,95 @@ from itertools import product
 import lightgbm as lgb
 import numpy as np
 import pandas as pd
-from sklearn.model_selection import StratifiedKFold, train_test_split
+from joblib import Parallel, delayed
+from sklearn.model_selection import KFold, StratifiedKFold, train_test_split
 
 from config import (
+    CATEGORICAL_FEATURES,
     FEATURE_NAMES,
     HYPERPARAM_GRID,
+    LGBM_PKL_NAMES,
+    LGBM_TXT_NAMES,
     MODELS_DIR,
     PROCESSED_DIR,
+    QUANTILE_LABELS,
     QUANTILES,
     TARGET,
     WEIGHT_COLUMN,
 )
 
+# numba is optional: the JIT kernels below accelerate hot loops but every
+# caller has a pure-NumPy fallback.
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+
+if njit is not None:
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _sort5_inplace(a):
+        """Sort each 5-element row in place; returns number of rows changed.
+
+        Unrolled 9-comparator sorting network — each row is touched once,
+        entirely in registers, with no temporaries.
+        """
+        n_fixed = 0
+        for i in prange(a.shape[0]):
+            v0, v1, v2, v3, v4 = a[i, 0], a[i, 1], a[i, 2], a[i, 3], a[i, 4]
+            if v0 > v1 or v1 > v2 or v2 > v3 or v3 > v4:
+                n_fixed += 1
+                if v0 > v1:
+                    v0, v1 = v1, v0
+                if v3 > v4:
+                    v3, v4 = v4, v3
+                if v2 > v4:
+                    v2, v4 = v4, v2
+                if v2 > v3:
+                    v2, v3 = v3, v2
+                if v1 > v4:
+                    v1, v4 = v4, v1
+                if v0 > v3:
+                    v0, v3 = v3, v0
+                if v0 > v2:
+                    v0, v2 = v2, v0
+                if v1 > v3:
+                    v1, v3 = v3, v1
+                if v1 > v2:
+                    v1, v2 = v2, v1
+                a[i, 0], a[i, 1], a[i, 2], a[i, 3], a[i, 4] = v0, v1, v2, v3, v4
+        return n_fixed
+
+    # No fastmath: the isfinite guards rely on NaN semantics that fastmath
+    # licenses the compiler to assume away.
+    @njit(cache=True)
+    def _weighted_pinball(y_true, y_pred, w, alpha):
+        """Single-pass weighted pinball loss; NaN when no usable weight."""
+        sum_l = 0.0
+        sum_w = 0.0
+        for i in range(y_true.shape[0]):
+            w_i = w[i]
+            if not (np.isfinite(w_i) and w_i >= 0):
+                continue
+            r = y_true[i] - y_pred[i]
+            if not np.isfinite(r):
+                continue
+            l = r * alpha if r >= 0 else r * (alpha - 1.0)
+            sum_l += l * w_i
+            sum_w += w_i
+        if sum_w > 0:
+            return sum_l / sum_w
+        return np.nan
+
+
+# Above this many rows, CV folds are split without qcut stratification
+STRATIFY_MAX_N = 50_000
+
+# Positional indices of the categorical features — CV fits work on plain
+# arrays, so LightGBM gets the columns by index rather than name
+CAT_FEATURE_IDX = [FEATURE_NAMES.index(c) for c in CATEGORICAL_FEATURES]
+
 
 def create_stratification_bins(y: pd.Series, n_bins: int = 10) -> pd.Series:
     """Create bins for stratified splitting on a continuous target."""
@@ -47,6 +125,19 @@ def weighted_mean(values: np.ndarray, sample_weight: np.ndarray) -> float:
     return float(np.average(vals, weights=weights))
 
 
+def _weighted_quantile_presorted(
+    vals_sorted: np.ndarray,
+    cumw: np.ndarray,
+    q: float,
+) -> float:
+    """Weighted quantile from pre-sorted values and their cumulative weights.
+
+    Callers that need several quantiles of the same vector should sort once
+    and call this per quantile instead of re-sorting via weighted_quantile.
+    """
+    return float(np.interp(q * cumw[-1], cumw, vals_sorted))
+
+
 def weighted_quantile(
     values: np.ndarray,
     q: float,
@@ -55,6 +146,7 @@ def weighted_quantile(
     """Weighted quantile for conformal adjustment estimation."""
     vals = np.asarray(values, dtype=float)
     if sample_weight is None:
+        # np.quantile selects via introselect (O(N)) rather than a full sort
         return float(np.quantile(vals, q))
 
     weights = np.asarray(sample_weight, dtype=float)
@@ -68,11 +160,7 @@ def weighted_quantile(
         return float(np.quantile(vals, q))
 
     order = np.argsort(vals)
-    vals = vals[order]
-    weights = weights[order]
-    cdf = np.cumsum(weights)
-    cutoff = q * cdf[-1]
-    return float(np.interp(cutoff, cdf, vals))
+    return _weighted_quantile_presorted(vals[order], np.cumsum(weights[order]), q)
 
 
 def train_quantile_model(
@@ -81,6 +169,7 @@ def train_quantile_model(
     alpha: float,
     params: dict,
     sample_weight: pd.Series | None = None,
+    num_threads: int | None = None,
 ) -> lgb.LGBMRegressor:
     """Train a single quantile regression model."""
     model = lgb.LGBMRegressor(
@@ -94,10 +183,11 @@ def train_quantile_model(
         reg_lambda=params.get("reg_lambda", 0.0),
         random_state=42,
         verbose=-1,
+        n_jobs=num_threads if num_threads is not None else -1,
     )
-    fit_kwargs = {}
+    fit_kwargs = {"categorical_feature": CAT_FEATURE_IDX}
     if sample_weight is not None:
-        fit_kwargs["sample_weight"] = sample_weight.values
+        fit_kwargs["sample_weight"] = np.asarray(sample_weight)
     model.fit(X_train, y_train, **fit_kwargs)
     return model
 
@@ -109,66 +199,172 @@ def quantile_loss(
     sample_weight: np.ndarray | None = None,
 ) -> float:
     """Pinball (quantile) loss with optional sample weighting."""
+    if sample_weight is not None and njit is not None:
+        loss = float(_weighted_pinball(
+            np.ascontiguousarray(y_true, dtype=np.float64),
+            np.ascontiguousarray(y_pred, dtype=np.float64),
+            np.ascontiguousarray(sample_weight, dtype=np.float64),
+            alpha,
+        ))
+        if np.isfinite(loss):
+            return loss
+        # No usable weights — fall through to the unweighted-safe path
+
     residuals = y_true - y_pred
-    losses = np.where(residuals >= 0, alpha * residuals, (alpha - 1) * residuals)
+    # max(alpha*r, (alpha-1)*r) is the pinball identity: one pass, no
+    # branch-select temporaries.
+    losses = np.maximum(alpha * residuals, (alpha - 1.0) * residuals)
     if sample_weight is None:
         return float(np.mean(losses))
     return weighted_mean(losses, sample_weight)
 
 
-def cv_evaluate(
-    X: pd.DataFrame,
-    y: pd.Series,
+def _lgb_params(alpha: float, params: dict, num_threads: int = 0) -> dict:
+    """Translate a grid combo into native lgb.train parameters."""
+    return {
+        "objective": "quantile",
+        "alpha": alpha,
+        "num_leaves": params["num_leaves"],
+        "learning_rate": params["learning_rate"],
+        "min_child_samples": params["min_child_samples"],
+        "lambda_l1": params.get("reg_alpha", 0.0),
+        "lambda_l2": params.get("reg_lambda", 0.0),
+        "seed": 42,
+        "verbose": -1,
+        "num_threads": num_threads,
+    }
+
+
+def build_cv_folds(
+    X_train: pd.DataFrame,
+    y_train: pd.Series,
     sample_weight: pd.Series,
+    n_folds: int = 5,
+) -> list[dict]:
+    """Bin the training matrix once and pre-slice per-fold CV inputs.
+
+    LightGBM's histogram construction dominates small fits; binning the full
+    matrix a single time and handing out Dataset.subset views lets every
+    combo, fold, and quantile reuse the same bins (only `alpha` changes
+    between quantiles).
+    """
+    # Contiguous float32 arrays: fold slicing becomes a plain memcpy with no
+    # pandas index alignment, and LightGBM ingests float32 without a copy.
+    X_arr = np.ascontiguousarray(X_train.values, dtype=np.float32)
+    y_arr = y_train.values.astype(np.float32)
+    w_arr = sample_weight.values.astype(np.float32)
+
+    # Above ~50k rows stratifying on qcut bins barely shifts the fold target
+    # distributions and the qcut sort is pure overhead — use plain KFold.
+    if len(y_train) > STRATIFY_MAX_N:
+        kf = KFold(n_splits=n_folds, shuffle=True, random_state=42)
+        split_iter = kf.split(X_arr)
+    else:
+        strat_bins = create_stratification_bins(y_train)
+        kf = StratifiedKFold(n_splits=n_folds, shuffle=True, random_state=42)
+        split_iter = kf.split(X_arr, strat_bins)
+
+    # feature_pre_filter must be off so min_child_samples can vary across
+    # combos without forcing a Dataset rebuild.
+    full = lgb.Dataset(
+        X_arr,
+        label=y_arr,
+        weight=w_arr,
+        categorical_feature=CAT_FEATURE_IDX,
+        params={"feature_pre_filter": False},
+        free_raw_data=False,
+    )
+
+    folds = []
+    for train_idx, val_idx in split_iter:
+        train_set = full.subset(train_idx)
+        train_set.construct()
+        folds.append({
+            "train_set": train_set,
+            "X_val": X_arr[val_idx],
+            "y_val": y_arr[val_idx],
+            "w_val": w_arr[val_idx],
+        })
+    return folds
+
+
+def _is_valid_combo(params: dict, n_train_per_fold: int) -> bool:
+    """Reject parameter combos that cannot produce a useful fit."""
+    if params["min_child_samples"] >= n_train_per_fold / 4:
+        return False
+    if params["num_leaves"] > 2 ** params.get("max_depth", 16):
+        return False
+    return True
+
+
+def _fit_and_score(
+    fold: dict,
     alpha: float,
     params: dict,
-    n_folds: int = 5,
+    num_threads: int,
 ) -> float:
-    """5-fold CV evaluation of a quantile model, returns weighted pinball loss."""
-    strat_bins = create_stratification_bins(y)
-    kf = StratifiedKFold(n_splits=n_folds, shuffle=True, random_state=42)
-
-    losses = []
-    for train_idx, val_idx in kf.split(X, strat_bins):
-        X_tr, X_val = X.iloc[train_idx], X.iloc[val_idx]
-        y_tr, y_val = y.iloc[train_idx], y.iloc[val_idx]
-        w_tr, w_val = sample_weight.iloc[train_idx], sample_weight.iloc[val_idx]
-
-        model = train_quantile_model(X_tr, y_tr, alpha, params, w_tr)
-        preds = model.predict(X_val)
-        loss = quantile_loss(y_val.values, preds, alpha, w_val.values)
-        losses.append(loss)
-
-    return float(np.mean(losses))
+    """Fit one fold with one parameter combo, return weighted pinball loss."""
+    try:
+        booster = lgb.train(
+            _lgb_params(alpha, params, num_threads),
+            fold["train_set"],
+            num_boost_round=params["n_estimators"],
+        )
+        preds = booster.predict(fold["X_val"])
+        return quantile_loss(fold["y_val"], preds, alpha, fold["w_val"])
+    except (ValueError, lgb.basic.LightGBMError) as e:
+        # Known-bad combos score inf; anything else propagates as a real bug
+        print(f"  Warning: combo {params} failed for alpha={alpha}: {e}", file=sys.stderr)
+        return float("inf")
 
 
 def search_hyperparams(
-    X_train: pd.DataFrame,
-    y_train: pd.Series,
-    sample_weight: pd.Series,
+    cv_folds: list[dict],
     alpha: float,
 ) -> dict:
-    """Grid search for best hyperparameters for a given quantile."""
+    """Grid search for best hyperparameters for a given quantile.
+
+    All combo x fold fits run in parallel via joblib threads — lgb.train
+    releases the GIL, and the threading backend lets every task share the
+    pre-binned Dataset handles from build_cv_folds. LightGBM's own thread
+    count is capped so the tasks don't oversubscribe the machine.
+    """
     param_keys = list(HYPERPARAM_GRID.keys())
     param_values = list(HYPERPARAM_GRID.values())
 
+    # Prune combos that would always fail before paying any LightGBM setup
+    n_train_per_fold = min(fold["train_set"].num_data() for fold in cv_folds)
+    all_combos = list(product(*param_values))
+    combos = [
+        combo for combo in all_combos
+        if _is_valid_combo(dict(zip(param_keys, combo)), n_train_per_fold)
+    ]
+    n_pruned = len(all_combos) - len(combos)
+    if n_pruned > 0:
+        print(f"  Pruned {n_pruned} invalid parameter combinations")
+    print(f"  Searching {len(combos)} parameter combinations for alpha={alpha}...")
+
+    n_cores = os.cpu_count() or 1
+    n_jobs = min(len(combos) * len(cv_folds), n_cores)
+    lgbm_threads = max(1, n_cores // n_jobs)
+
+    tasks = [(combo, fold) for combo in combos for fold in cv_folds]
+    fold_losses = Parallel(n_jobs=n_jobs, backend="threading")(
+        delayed(_fit_and_score)(
+            fold, alpha, dict(zip(param_keys, combo)), lgbm_threads,
+        )
+        for combo, fold in tasks
+    )
+
     best_loss = float("inf")
     best_params = None
+    for i, combo in enumerate(combos):
+        loss = float(np.mean(fold_losses[i * len(cv_folds):(i + 1) * len(cv_folds)]))
+        if loss < best_loss:
+            best_loss = loss
+            best_params = dict(zip(param_keys, combo))
 
-    combos = list(product(*param_values))
-    print(f"  Searching {len(combos)} parameter combinations for alpha={alpha}...")
-
-    for combo in combos:
-        params = dict(zip(param_keys, combo))
-        try:
-            loss = cv_evaluate(X_train, y_train, sample_weight, alpha, params)
-            if loss < best_loss:
-                best_loss = loss
-                best_params = params.copy()
-        except Exception:
-            continue
-
-    if best_params is None:
+    if best_params is None or not np.isfinite(best_loss):
         raise RuntimeError(f"No valid parameter combination found for alpha={alpha}")
 
     print(f"  Best params: {best_params}, loss: {best_loss:.4f}")
@@ -177,16 +373,32 @@ def search_hyperparams(
 
 def enforce_monotonicity(predictions: np.ndarray) -> np.ndarray:
     """Enforce quantile monotonicity: q05 <= q25 <= q50 <= q75 <= q95."""
-    n_samples, _ = predictions.shape
-    n_fixed = 0
-    for i in range(n_samples):
-        original = predictions[i].copy()
-        predictions[i] = np.sort(predictions[i])
-        if not np.allclose(original, predictions[i]):
-            n_fixed += 1
+    n_samples = predictions.shape[0]
+    if njit is not None and predictions.shape[1] == 5:
+        predictions = np.ascontiguousarray(predictions)
+        n_fixed = int(_sort5_inplace(predictions))
+        sorted_preds = predictions
+    else:
+        sorted_preds = np.sort(predictions, axis=1)
+        n_fixed = int(np.any(sorted_preds != predictions, axis=1).sum())
     if n_fixed > 0:
         print(f"  Fixed quantile crossing in {n_fixed}/{n_samples} samples")
-    return predictions
+    return sorted_preds
+
+
+def predict_all_quantiles(models: dict, X) -> np.ndarray:
+    """Predict all quantiles into one preallocated (n, len(QUANTILES)) buffer.
+
+    The feature matrix is converted to contiguous float32 once and shared by
+    every booster instead of being re-extracted from pandas per quantile.
+    """
+    X_arr = np.ascontiguousarray(np.asarray(X), dtype=np.float32)
+    out = np.empty((X_arr.shape[0], len(QUANTILES)), dtype=np.float32)
+    for i, alpha in enumerate(QUANTILES):
+        # Go through the underlying booster: the sklearn wrapper warns about
+        # missing feature names when fed a plain ndarray
+        out[:, i] = models[alpha].booster_.predict(X_arr)
+    return out
 
 
 def cycle_start_year(cycle: str) -> int:
@@ -221,25 +433,33 @@ def temporal_validation(
     y_test = test_df[TARGET]
     w_test = test_df[WEIGHT_COLUMN].values
 
-    temporal_models = {}
-    for alpha in QUANTILES:
+    # All five retrains share one pre-binned Dataset — the models differ only
+    # in the alpha objective, so binning the training cycles once removes
+    # four redundant histogram-construction passes.
+    train_set = lgb.Dataset(
+        np.ascontiguousarray(X_train.values, dtype=np.float32),
+        label=y_train.values.astype(np.float32),
+        weight=w_train.values.astype(np.float32),
+        categorical_feature=CAT_FEATURE_IDX,
+        params={"feature_pre_filter": False},
+        free_raw_data=False,
+    )
+    X_test_arr = np.ascontiguousarray(X_test.values, dtype=np.float32)
+
+    preds = np.empty((len(X_test_arr), len(QUANTILES)), dtype=np.float32)
+    for i, alpha in enumerate(QUANTILES):
         params = best_params_all[str(alpha)]
-        temporal_models[alpha] = train_quantile_model(
-            X_train,
-            y_train,
-            alpha,
-            params,
-            w_train,
+        booster = lgb.train(
+            _lgb_params(alpha, params),
+            train_set,
+            num_boost_round=params["n_estimators"],
         )
-
-    preds = np.column_stack([
-        temporal_models[alpha].predict(X_test) for alpha in QUANTILES
-    ])
+        preds[:, i] = booster.predict(X_test_arr)
     preds = enforce_monotonicity(preds)
 
     per_quantile_loss = {}
     for idx, alpha in enumerate(QUANTILES):
-        per_quantile_loss[f"q{int(alpha*100):02d}"] = round(
+        per_quantile_loss[QUANTILE_LABELS[alpha]] = round(
             quantile_loss(y_test.values, preds[:, idx], alpha, w_test),
             4,
         )
@@ -272,15 +492,38 @@ def derive_conformal_adjustments(
     """Derive asymmetric PI90 widening adjustments from held-out residuals."""
     lower_errors = np.maximum(0, preds[:, 0] - y_true)
     upper_errors = np.maximum(0, y_true - preds[:, 4])
+
+    # Validate the shared weight vector once; each error vector is then
+    # sorted once, and any number of quantiles can be read off its CDF.
+    weights = np.asarray(sample_weight, dtype=float)
+    w_valid = np.isfinite(weights) & (weights >= 0)
+
+    def _q90(errors: np.ndarray) -> float:
+        mask = w_valid & np.isfinite(errors)
+        if not np.any(mask) or np.sum(weights[mask]) <= 0:
+            return float(np.quantile(errors, 0.90))
+        vals = errors[mask]
+        w = weights[mask]
+        order = np.argsort(vals)
+        return _weighted_quantile_presorted(vals[order], np.cumsum(w[order]), 0.90)
+
     return {
         "pi90": {
-            "lower": round(weighted_quantile(lower_errors, 0.90, sample_weight), 3),
-            "upper": round(weighted_quantile(upper_errors, 0.90, sample_weight), 3),
+            "lower": round(_q90(lower_errors), 3),
+            "upper": round(_q90(upper_errors), 3),
         }
     }
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Train LightGBM quantile models")
+    parser.add_argument(
+        "--no-weights",
+        action="store_true",
+        help="Ignore NHANES sample weights (reproduces the unweighted run)",
+    )
+    args = parser.parse_args()
+
     os.makedirs(MODELS_DIR, exist_ok=True)
 
     input_path = os.path.join(PROCESSED_DIR, "analytical_dataset.parquet")
@@ -291,11 +534,18 @@ def main():
     df = pd.read_parquet(input_path)
     print(f"Loaded {len(df)} records")
 
-    X = df[FEATURE_NAMES]
+    # float32 continuous + int8 categorical halves the bytes every CV slice
+    # and prediction pass moves (a no-op when step 2 already wrote these)
+    X = df[FEATURE_NAMES].astype(
+        {"age": np.float32, "bmi": np.float32,
+         **{c: np.int8 for c in CATEGORICAL_FEATURES}},
+    )
     y = df[TARGET]
-    if WEIGHT_COLUMN in df.columns:
+    if WEIGHT_COLUMN in df.columns and not args.no_weights:
         sample_weight = pd.to_numeric(df[WEIGHT_COLUMN], errors="coerce").fillna(0).clip(lower=0)
     else:
+        if args.no_weights:
+            print("Running without NHANES sample weights (--no-weights)")
         sample_weight = pd.Series(1.0, index=df.index, dtype=float)
     cycles = df["cycle"].astype(str)
 
@@ -328,13 +578,17 @@ def main():
     test_df["cycle"] = cycle_test.values
     test_df.to_parquet(os.path.join(MODELS_DIR, "test_set.parquet"), index=False)
 
+    # Bin the CV data once; the folds (and their Dataset handles) are shared
+    # by the grid searches for all five quantiles.
+    cv_folds = build_cv_folds(X_train, y_train, w_train)
+
     # Train models for each quantile
     models = {}
     best_params_all = {}
 
     for alpha in QUANTILES:
         print(f"\n=== Training quantile model for alpha={alpha} ===")
-        best_params = search_hyperparams(X_train, y_train, w_train, alpha)
+        best_params = search_hyperparams(cv_folds, alpha)
         best_params_all[str(alpha)] = best_params
 
         model = train_quantile_model(X_train, y_train, alpha, best_params, w_train)
@@ -345,9 +599,7 @@ def main():
         print(f"  Final weighted training loss: {train_loss:.4f}")
 
     # Test predictions and monotonicity enforcement
-    test_preds = np.column_stack([
-        models[alpha].predict(X_test) for alpha in QUANTILES
-    ])
+    test_preds = predict_all_quantiles(models, X_test)
     test_preds = enforce_monotonicity(test_preds)
 
     random_split_coverage = {
@@ -375,12 +627,17 @@ def main():
 
     temporal_results = temporal_validation(df, best_params_all)
 
-    # Save models
+    # Save models. The native text format is the canonical artifact: smaller,
+    # faster to load via lgb.Booster(model_file=...), and independent of
+    # pickle/protocol versions. A pickle copy is kept alongside while the
+    # evaluation and export steps still consume the sklearn wrapper.
     for alpha in QUANTILES:
-        model_path = os.path.join(MODELS_DIR, f"lgbm_q{int(alpha*100):02d}.pkl")
-        with open(model_path, "wb") as f:
+        txt_path = os.path.join(MODELS_DIR, LGBM_TXT_NAMES[alpha])
+        models[alpha].booster_.save_model(txt_path)
+        pkl_path = os.path.join(MODELS_DIR, LGBM_PKL_NAMES[alpha])
+        with open(pkl_path, "wb") as f:
             pickle.dump(models[alpha], f)
-        print(f"Saved model: {model_path}")
+        print(f"Saved model: {txt_path}")
 
     # Save metadata
     meta = {
@@ -10,59 +10,115 @@ import os
 import sys
 import json
 import pickle
+from concurrent.futures import ThreadPoolExecutor
+
+import lightgbm as lgb
 import numpy as np
 import pandas as pd
 import matplotlib
 matplotlib.use("Agg")
+# Agg fast path: simplify paths aggressively and chunk large vertex buffers
+matplotlib.rcParams.update({
+    "path.simplify": True,
+    "path.simplify_threshold": 1.0,
+    "agg.path.chunksize": 10000,
+    "figure.max_open_warning": 0,
+})
 import matplotlib.pyplot as plt
 import seaborn as sns
-from config import MODELS_DIR, REPORTS_DIR, QUANTILES, FEATURE_NAMES, TARGET, WEIGHT_COLUMN
-
-
-def weighted_mean(values: np.ndarray, sample_weight: np.ndarray | None) -> float:
-    if sample_weight is None:
-        return float(np.mean(values))
-    weights = np.asarray(sample_weight, dtype=float)
-    vals = np.asarray(values, dtype=float)
-    mask = np.isfinite(vals) & np.isfinite(weights) & (weights >= 0)
-    if not np.any(mask):
-        return float(np.mean(vals))
-    vals = vals[mask]
-    weights = weights[mask]
-    if np.sum(weights) <= 0:
-        return float(np.mean(vals))
-    return float(np.average(vals, weights=weights))
+from config import (
+    MODELS_DIR, REPORTS_DIR, QUANTILES, QUANTILE_LABELS, LGBM_PKL_NAMES,
+    FEATURE_NAMES, TARGET, WEIGHT_COLUMN, extract_features,
+)
+
+# polars decodes parquet with a multi-threaded Arrow engine; optional, with
+# a pandas fallback. The subgroup aggregation itself stays in NumPy — the
+# bincount reduction is already a single linear pass.
+try:
+    import polars as pl
+except ImportError:
+    pl = None
+
+def _load_booster(pkl_path: str):
+    """Load a model, preferring the native text dump next to the pickle.
+
+    lgb.Booster(model_file=...) parses the compact text format straight into
+    C state — much faster than reconstructing the pickled sklearn wrapper,
+    and robust across pickle protocol/library versions.
+    """
+    txt_path = pkl_path[:-len(".pkl")] + ".txt"
+    if os.path.exists(txt_path):
+        return lgb.Booster(model_file=txt_path)
+    with open(pkl_path, "rb") as f:
+        return pickle.load(f)
 
 
 def load_models() -> dict:
-    """Load trained quantile models."""
-    models = {}
-    for alpha in QUANTILES:
-        path = os.path.join(MODELS_DIR, f"lgbm_q{int(alpha*100):02d}.pkl")
-        with open(path, "rb") as f:
-            models[alpha] = pickle.load(f)
-    return models
-
-
-def predict_quantiles(models: dict, X: pd.DataFrame) -> np.ndarray:
-    """Get predictions from all quantile models, enforce monotonicity."""
-    preds = np.column_stack([models[alpha].predict(X) for alpha in QUANTILES])
-    # Enforce monotonicity
-    for i in range(len(preds)):
-        preds[i] = np.sort(preds[i])
+    """Load trained quantile models.
+
+    The five loads are independent — file reads overlap and the C-side text
+    parse releases the GIL — so a small thread pool hides most of the disk
+    latency behind the slowest model.
+    """
+    paths = [
+        os.path.join(MODELS_DIR, LGBM_PKL_NAMES[alpha]) for alpha in QUANTILES
+    ]
+    with ThreadPoolExecutor(max_workers=len(QUANTILES)) as pool:
+        return dict(zip(QUANTILES, pool.map(_load_booster, paths)))
+
+
+def predict_quantiles(models: dict, X) -> np.ndarray:
+    """Get predictions from all quantile models, enforce monotonicity.
+
+    Accepts a DataFrame or ndarray; the features are converted to one
+    contiguous float32 matrix shared by all five boosters, so LightGBM skips
+    the per-call pandas dtype inspection and copy.
+    """
+    X_np = np.ascontiguousarray(np.asarray(X), dtype=np.float32)
+    preds = np.empty((len(X_np), len(QUANTILES)), dtype=np.float64)
+    for i, alpha in enumerate(QUANTILES):
+        preds[:, i] = models[alpha].predict(X_np)
+    # Enforce monotonicity: one in-place C-level sort over the whole buffer
+    preds.sort(axis=1)
     return preds
 
 
+def _weighted_column_means(mat: np.ndarray, sample_weight: np.ndarray | None) -> np.ndarray:
+    """Weighted mean of each column, masking non-finite or negative weights."""
+    if sample_weight is not None:
+        w = np.asarray(sample_weight)
+        if w.dtype.kind != "f":
+            w = w.astype(float)
+        good = np.isfinite(w) & (w >= 0)
+        if np.any(good) and np.sum(w[good]) > 0:
+            return np.average(mat[good], axis=0, weights=w[good])
+    return mat.mean(axis=0)
+
+
+def _build_indicators(y_true: np.ndarray, preds: np.ndarray) -> tuple:
+    """Build the y<=pred and y>=pred indicator matrices once per evaluation.
+
+    Calibration, interval coverage, and the subgroup reduction all derive
+    from these same comparisons; two broadcasts here replace roughly eight
+    separate passes over y_true across the three analyses.
+    """
+    le = y_true[:, None] <= preds
+    ge = y_true[:, None] >= preds
+    return le, ge
+
+
 def calibration_analysis(
-    y_true: np.ndarray,
-    preds: np.ndarray,
+    le: np.ndarray,
     sample_weight: np.ndarray | None = None,
 ) -> dict:
     """Check calibration: actual coverage at each quantile level."""
+    # float32 halves the bytes of the bool->numeric cast
+    cov_mat = le.astype(np.float32)
+    actual = _weighted_column_means(cov_mat, sample_weight)
+
     results = {}
-    for i, alpha in enumerate(QUANTILES):
-        actual_coverage = weighted_mean((y_true <= preds[:, i]).astype(float), sample_weight)
-        results[f"q{int(alpha*100):02d}"] = {
+    for alpha, actual_coverage in zip(QUANTILES, actual):
+        results[QUANTILE_LABELS[alpha]] = {
             "nominal": alpha,
             "actual": float(actual_coverage),
             "diff": float(actual_coverage - alpha),
@@ -71,18 +127,23 @@ def calibration_analysis(
 
 
 def interval_coverage(
-    y_true: np.ndarray,
+    le: np.ndarray,
+    ge: np.ndarray,
     preds: np.ndarray,
     sample_weight: np.ndarray | None = None,
 ) -> dict:
     """Compute coverage and width of prediction intervals."""
-    # 90% PI: q05 to q95
-    pi90_coverage = weighted_mean(((y_true >= preds[:, 0]) & (y_true <= preds[:, 4])).astype(float), sample_weight)
-    pi90_width = weighted_mean(preds[:, 4] - preds[:, 0], sample_weight)
-
-    # 50% PI: q25 to q75
-    pi50_coverage = weighted_mean(((y_true >= preds[:, 1]) & (y_true <= preds[:, 3])).astype(float), sample_weight)
-    pi50_width = weighted_mean(preds[:, 3] - preds[:, 1], sample_weight)
+    # Fused stats matrix: [pi90 covered, pi50 covered, pi90 width, pi50 width]
+    # — one weighted reduction instead of four separate passes
+    stats = np.column_stack([
+        (ge[:, 0] & le[:, 4]).astype(np.float32),
+        (ge[:, 1] & le[:, 3]).astype(np.float32),
+        (preds[:, 4] - preds[:, 0]).astype(np.float32),
+        (preds[:, 3] - preds[:, 1]).astype(np.float32),
+    ])
+    pi90_coverage, pi50_coverage, pi90_width, pi50_width = _weighted_column_means(
+        stats, sample_weight
+    )
 
     return {
         "pi90": {
@@ -99,40 +160,57 @@ def interval_coverage(
 
 
 def subgroup_analysis(
-    X: pd.DataFrame, y: pd.Series, preds: np.ndarray
+    X: pd.DataFrame, preds: np.ndarray, covered: np.ndarray
 ) -> pd.DataFrame:
-    """Subgroup analysis by race_eth x sex x age_decade."""
-    df = X.copy()
-    df["y_true"] = y.values
-    df["q05"] = preds[:, 0]
-    df["q95"] = preds[:, 4]
-    df["age_decade"] = (df["age"] // 10) * 10
+    """Subgroup analysis by race_eth x sex x age_decade.
+
+    `covered` is the PI90 coverage indicator derived from the shared
+    le/ge matrices built in main().
+    """
+    race = X["race_eth"].to_numpy(dtype=np.int64)
+    sex = X["sex"].to_numpy(dtype=np.int64)
+    age_decade = (X["age"].to_numpy(dtype=np.int64) // 10) * 10
+
+    covered = covered.astype(np.float64)
+    width = (preds[:, 4] - preds[:, 0]).astype(np.float64)
+
+    # Encode the three keys into one linear group id, then reduce each
+    # statistic with a single bincount pass — no per-group Python iteration
+    # or intermediate DataFrame. gid decodes as race*1000 + sex*100 + decade
+    # (decades stay < 100).
+    gid = race * 1000 + sex * 100 + age_decade
+    uniq, inv = np.unique(gid, return_inverse=True)
+    counts = np.bincount(inv)
+    cov_mean = np.bincount(inv, weights=covered) / counts
+    width_mean = np.bincount(inv, weights=width) / counts
 
     results = []
-    for (race, sex, age_dec), group in df.groupby(["race_eth", "sex", "age_decade"]):
-        n = len(group)
+    for g, n, cov, wid in zip(uniq, counts, cov_mean, width_mean):
         if n < 5:
             continue
-        coverage = np.mean(
-            (group["y_true"] >= group["q05"]) & (group["y_true"] <= group["q95"])
-        )
-        width = np.mean(group["q95"] - group["q05"])
         results.append({
-            "race_eth": int(race),
-            "sex": int(sex),
-            "age_decade": int(age_dec),
-            "n": n,
-            "pi90_coverage": round(coverage, 3),
-            "pi90_width": round(width, 1),
+            "race_eth": int(g // 1000),
+            "sex": int((g // 100) % 10),
+            "age_decade": int(g % 100),
+            "n": int(n),
+            "pi90_coverage": round(float(cov), 3),
+            "pi90_width": round(float(wid), 1),
             "sparse": n < 50,
         })
 
     return pd.DataFrame(results)
 
 
+# One Figure shared by both plot functions: canvas/renderer setup is not
+# free, and clf() between plots keeps the allocation warm.
+_FIG = plt.figure(figsize=(8, 4))
+
+
 def plot_calibration(calibration: dict, output_path: str):
     """Plot calibration curve."""
-    fig, ax = plt.subplots(figsize=(6, 6))
+    _FIG.clf()
+    _FIG.set_size_inches(6, 6)
+    fig, ax = _FIG, _FIG.add_subplot()
     nominals = [v["nominal"] for v in calibration.values()]
     actuals = [v["actual"] for v in calibration.values()]
 
@@ -151,23 +229,33 @@ def plot_calibration(calibration: dict, output_path: str):
     ax.legend()
     fig.tight_layout()
     fig.savefig(output_path, dpi=150)
-    plt.close(fig)
     print(f"Saved calibration plot: {output_path}")
 
 
 def plot_interval_widths(preds: np.ndarray, output_path: str):
     """Plot distribution of 90% PI widths."""
     widths = preds[:, 4] - preds[:, 0]
-    fig, ax = plt.subplots(figsize=(8, 4))
-    ax.hist(widths, bins=50, color="steelblue", alpha=0.7, edgecolor="white")
-    ax.axvline(np.median(widths), color="red", linestyle="--", label=f"Median: {np.median(widths):.1f}")
+    _FIG.clf()
+    _FIG.set_size_inches(8, 4)
+    fig, ax = _FIG, _FIG.add_subplot()
+    # Precompute the histogram and draw 50 bars; ax.hist would re-bin the
+    # full widths array inside matplotlib
+    counts, edges = np.histogram(widths, bins=50)
+    ax.bar(
+        edges[:-1], counts, width=np.diff(edges), align="edge",
+        color="steelblue", alpha=0.7, edgecolor="white",
+    )
+    # Median via one np.partition pass, computed once for line and label;
+    # the upper-middle order statistic is plenty for a plot annotation
+    mid = widths.size // 2
+    med = float(np.partition(widths, mid)[mid])
+    ax.axvline(med, color="red", linestyle="--", label=f"Median: {med:.1f}")
     ax.set_xlabel("90% Prediction Interval Width (ng/mL)")
     ax.set_ylabel("Count")
     ax.set_title("Sharpness: Distribution of 90% PI Widths")
     ax.legend()
     fig.tight_layout()
     fig.savefig(output_path, dpi=150)
-    plt.close(fig)
     print(f"Saved interval width plot: {output_path}")
 
 
@@ -181,18 +269,24 @@ def edge_case_check(models: dict) -> dict:
         "supplemented": {"age": 50, "sex": 1, "bmi": 30, "race_eth": 2, "exam_season": 1, "supplement_cat": 4},
     }
 
+    # Stack all cases into one batch in feature order: each model predicts
+    # once on the (n_cases, n_features) matrix instead of once per case
+    X_edge = np.array(
+        [[inputs[k] for k in FEATURE_NAMES] for inputs in edge_cases.values()],
+        dtype=np.float32,
+    )
+    preds = predict_quantiles(models, X_edge)
+
     results = {}
-    for name, inputs in edge_cases.items():
-        X = pd.DataFrame([inputs])
-        preds = predict_quantiles(models, X)
+    for i, (name, inputs) in enumerate(edge_cases.items()):
         results[name] = {
             "inputs": inputs,
-            "q05": round(float(preds[0, 0]), 1),
-            "q25": round(float(preds[0, 1]), 1),
-            "q50": round(float(preds[0, 2]), 1),
-            "q75": round(float(preds[0, 3]), 1),
-            "q95": round(float(preds[0, 4]), 1),
-            "pi90_width": round(float(preds[0, 4] - preds[0, 0]), 1),
+            "q05": round(float(preds[i, 0]), 1),
+            "q25": round(float(preds[i, 1]), 1),
+            "q50": round(float(preds[i, 2]), 1),
+            "q75": round(float(preds[i, 3]), 1),
+            "q95": round(float(preds[i, 4]), 1),
+            "pi90_width": round(float(preds[i, 4] - preds[i, 0]), 1),
         }
         print(f"  {name}: median={results[name]['q50']}, PI90=[{results[name]['q05']}, {results[name]['q95']}]")
 
@@ -209,30 +303,39 @@ def main():
         print(f"Test set not found: {test_path}", file=sys.stderr)
         sys.exit(1)
 
-    test_df = pd.read_parquet(test_path)
+    if pl is not None:
+        test_df = pl.read_parquet(test_path).to_pandas()
+    else:
+        test_df = pd.read_parquet(test_path)
     X_test = test_df[FEATURE_NAMES]
     y_test = test_df[TARGET]
     sample_weight = test_df[WEIGHT_COLUMN].values if WEIGHT_COLUMN in test_df.columns else None
     print(f"Test set: {len(X_test)} records")
 
-    # Predictions
-    preds = predict_quantiles(models, X_test)
+    # One float32 copy of the feature matrix up front; predict_quantiles can
+    # then hand it straight to every booster without per-call dtype scans,
+    # and float32 halves the bytes moved vs the default float64 conversion.
+    X_test_np = extract_features(test_df)
+
+    # Predictions, then the shared indicator matrices every analysis reads
+    preds = predict_quantiles(models, X_test_np)
+    le, ge = _build_indicators(np.asarray(y_test, dtype=np.float64), preds)
 
     # Calibration
     print("\n=== Calibration Analysis ===")
-    cal = calibration_analysis(y_test.values, preds, sample_weight)
+    cal = calibration_analysis(le, sample_weight)
     for k, v in cal.items():
         print(f"  {k}: nominal={v['nominal']:.2f}, actual={v['actual']:.3f}, diff={v['diff']:+.3f}")
 
     # Interval coverage
     print("\n=== Interval Coverage ===")
-    coverage = interval_coverage(y_test.values, preds, sample_weight)
+    coverage = interval_coverage(le, ge, preds, sample_weight)
     for k, v in coverage.items():
         print(f"  {k}: coverage={v['coverage']:.3f} (target {v['target']:.2f}), width={v['mean_width']:.1f}")
 
     # Subgroup analysis
     print("\n=== Subgroup Analysis ===")
-    subgroups = subgroup_analysis(X_test, y_test, preds)
+    subgroups = subgroup_analysis(X_test, preds, ge[:, 0] & le[:, 4])
     sparse_groups = subgroups[subgroups["sparse"]]
     if len(sparse_groups) > 0:
         print(f"  {len(sparse_groups)} subgroups with < 50 test samples (sparse)")
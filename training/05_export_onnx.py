@@ -10,6 +10,9 @@ import os
 import sys
 import json
 import pickle
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import lightgbm as lgb
 import numpy as np
 import pandas as pd
 import onnx
@@ -17,11 +20,21 @@ import onnxruntime as ort
 from onnxmltools import convert_lightgbm
 from onnxmltools.convert.common.data_types import FloatTensorType
 from config import (
-    MODELS_DIR, REPORTS_DIR, QUANTILES, FEATURE_NAMES, TARGET,
-    THRESHOLDS, RACE_ETH_MAP, SEX_MAP
+    MODELS_DIR, REPORTS_DIR, QUANTILES, QUANTILE_LABELS, LGBM_PKL_NAMES,
+    ONNX_NAMES, FEATURE_NAMES, TARGET, THRESHOLDS, RACE_ETH_MAP, SEX_MAP,
+    extract_features
 )
 
 
+def _load_booster(pkl_path: str):
+    """Load a model, preferring the native text dump next to the pickle."""
+    txt_path = pkl_path[:-len(".pkl")] + ".txt"
+    if os.path.exists(txt_path):
+        return lgb.Booster(model_file=txt_path)
+    with open(pkl_path, "rb") as f:
+        return pickle.load(f)
+
+
 def export_single_model(model, feature_names: list, output_path: str):
     """Export a single LightGBM model to ONNX."""
     initial_type = [("features", FloatTensorType([None, len(feature_names)]))]
@@ -30,24 +43,41 @@ def export_single_model(model, feature_names: list, output_path: str):
     return onnx_model
 
 
-def validate_onnx_model(lgbm_model, onnx_path: str, X_sample: pd.DataFrame, alpha: float):
-    """Validate ONNX model outputs match LightGBM predictions."""
+def _export_one(alpha: float, feature_names: list, models_dir: str, onnx_dir: str) -> tuple:
+    """Worker: load one model, convert it to ONNX, and save it.
+
+    Runs in a subprocess — conversions are CPU-bound and independent across
+    quantiles — so the model is loaded here rather than shipped over pickle.
+    Returns (alpha, onnx_path, size_kb).
+    """
+    model = _load_booster(os.path.join(models_dir, LGBM_PKL_NAMES[alpha]))
+    onnx_path = os.path.join(onnx_dir, ONNX_NAMES[alpha])
+    export_single_model(model, feature_names, onnx_path)
+    return alpha, onnx_path, os.path.getsize(onnx_path) / 1024
+
+
+def validate_onnx_model(lgbm_model, session: ort.InferenceSession, X_np: np.ndarray, alpha: float):
+    """Validate ONNX model outputs match LightGBM predictions.
+
+    Takes a pre-built InferenceSession and a shared float32 batch — session
+    construction (graph parse, kernel allocation) dwarfs the actual 100-row
+    inference, so it happens once per model in the caller.
+    """
     # LightGBM predictions
-    lgbm_preds = lgbm_model.predict(X_sample)
+    lgbm_preds = lgbm_model.predict(X_np)
 
     # ONNX predictions
-    session = ort.InferenceSession(onnx_path)
     input_name = session.get_inputs()[0].name
-    X_np = X_sample.values.astype(np.float32)
     onnx_result = session.run(None, {input_name: X_np})
     onnx_preds = onnx_result[0].flatten()
 
     max_diff = np.max(np.abs(lgbm_preds - onnx_preds))
     mean_diff = np.mean(np.abs(lgbm_preds - onnx_preds))
-    print(f"  Q{int(alpha*100):02d}: max_diff={max_diff:.6f}, mean_diff={mean_diff:.6f}")
+    label = QUANTILE_LABELS[alpha]
+    print(f"  {label.upper()}: max_diff={max_diff:.6f}, mean_diff={mean_diff:.6f}")
 
     if max_diff > 0.01:
-        print(f"  WARNING: Max difference exceeds 0.01 ng/mL for q{int(alpha*100):02d}!")
+        print(f"  WARNING: Max difference exceeds 0.01 ng/mL for {label}!")
         return False
     return True
 
@@ -146,28 +176,49 @@ def main():
     test_df = pd.read_parquet(test_path)
     X_sample = test_df[FEATURE_NAMES].head(100)
 
+    # Load each booster once; export, validation, and fixture generation all
+    # reuse the same objects instead of re-unpickling per stage. The loads
+    # are independent file reads, so they overlap on a small thread pool.
+    model_paths = [
+        os.path.join(MODELS_DIR, LGBM_PKL_NAMES[alpha]) for alpha in QUANTILES
+    ]
+    with ThreadPoolExecutor(max_workers=len(QUANTILES)) as load_pool:
+        models = dict(zip(QUANTILES, load_pool.map(_load_booster, model_paths)))
+
     print("=== Exporting ONNX models ===\n")
 
+    # One contiguous float32 batch shared by LightGBM and every ORT session
+    X_np = extract_features(X_sample)
+    sess_opts = ort.SessionOptions()
+    sess_opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+
     all_valid = True
     onnx_sizes = {}
 
-    for alpha in QUANTILES:
-        model_path = os.path.join(MODELS_DIR, f"lgbm_q{int(alpha*100):02d}.pkl")
-        with open(model_path, "rb") as f:
-            model = pickle.load(f)
-
-        onnx_path = os.path.join(onnx_dir, f"quantile_q{int(alpha*100):02d}.onnx")
-        print(f"Exporting q{int(alpha*100):02d}...")
-        export_single_model(model, FEATURE_NAMES, onnx_path)
-
-        # Validate
-        valid = validate_onnx_model(model, onnx_path, X_sample, alpha)
+    # Convert all five models concurrently in worker processes; validation
+    # runs sequentially afterward so ORT session creation stays deterministic.
+    with ProcessPoolExecutor(
+        max_workers=min(len(QUANTILES), os.cpu_count() or 1)
+    ) as pool:
+        export_futures = {
+            alpha: pool.submit(_export_one, alpha, FEATURE_NAMES, MODELS_DIR, onnx_dir)
+            for alpha in QUANTILES
+        }
+        exported = {alpha: fut.result() for alpha, fut in export_futures.items()}
+
+    for alpha, model in models.items():
+        _, onnx_path, size_kb = exported[alpha]
+        print(f"Exported {QUANTILE_LABELS[alpha]}")
+
+        # Validate against a session built once per model
+        session = ort.InferenceSession(
+            onnx_path, sess_opts, providers=["CPUExecutionProvider"]
+        )
+        valid = validate_onnx_model(model, session, X_np, alpha)
         if not valid:
             all_valid = False
 
-        # Track size
-        size_kb = os.path.getsize(onnx_path) / 1024
-        onnx_sizes[f"q{int(alpha*100):02d}"] = f"{size_kb:.1f} KB"
+        onnx_sizes[QUANTILE_LABELS[alpha]] = f"{size_kb:.1f} KB"
         print(f"  Size: {size_kb:.1f} KB")
 
     print(f"\nTotal ONNX size: {sum(os.path.getsize(os.path.join(onnx_dir, f)) for f in os.listdir(onnx_dir) if f.endswith('.onnx')) / 1024:.1f} KB")
@@ -180,7 +231,7 @@ def main():
     # Generate model_meta.json
     print("\n=== Generating model_meta.json ===")
     meta = create_model_meta(MODELS_DIR, REPORTS_DIR)
-    meta["onnx_files"] = [f"quantile_q{int(alpha*100):02d}.onnx" for alpha in QUANTILES]
+    meta["onnx_files"] = [ONNX_NAMES[alpha] for alpha in QUANTILES]
     meta["onnx_sizes"] = onnx_sizes
     meta["validation_passed"] = all_valid
 
@@ -189,22 +240,21 @@ def main():
         json.dump(meta, f, indent=2)
     print(f"Saved model_meta.json to {meta_path}")
 
-    # Generate test fixtures for browser validation
+    # Generate test fixtures for browser validation: one batched prediction
+    # per model, indexed per fixture row.
     print("\n=== Generating test fixtures ===")
-    fixtures = []
-    for i in range(min(20, len(X_sample))):
-        row = X_sample.iloc[i]
-        preds = {}
-        for alpha in QUANTILES:
-            model_path = os.path.join(MODELS_DIR, f"lgbm_q{int(alpha*100):02d}.pkl")
-            with open(model_path, "rb") as f:
-                model = pickle.load(f)
-            pred = float(model.predict(pd.DataFrame([row]))[0])
-            preds[f"q{int(alpha*100):02d}"] = round(pred, 2)
+    fixture_X = X_sample.head(min(20, len(X_sample)))
+    pred_mat = {alpha: models[alpha].predict(fixture_X) for alpha in QUANTILES}
 
+    fixtures = []
+    for i in range(len(fixture_X)):
+        row = fixture_X.iloc[i]
         fixtures.append({
             "inputs": {k: float(row[k]) for k in FEATURE_NAMES},
-            "expected": preds,
+            "expected": {
+                QUANTILE_LABELS[alpha]: round(float(pred_mat[alpha][i]), 2)
+                for alpha in QUANTILES
+            },
         })
 
     fixtures_path = os.path.join(onnx_dir, "test_fixtures.json")
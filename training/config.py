@@ -2,6 +2,8 @@
 
 import os
 
+import numpy as np
+
 # Paths
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.path.join(BASE_DIR, "data")
@@ -89,9 +91,22 @@ NMOL_TO_NGML = 2.496
 
 # Feature names for model
 FEATURE_NAMES = ["age", "sex", "bmi", "race_eth", "exam_season", "supplement_cat"]
+# Subset of FEATURE_NAMES that LightGBM should treat as unordered categories
+# rather than low-cardinality floats
+CATEGORICAL_FEATURES = ["sex", "race_eth", "exam_season", "supplement_cat"]
 TARGET = "vitd_ng"
 WEIGHT_COLUMN = "sample_weight"
 
+
+def extract_features(df) -> np.ndarray:
+    """Feature matrix in FEATURE_NAMES order as one contiguous float32 array.
+
+    Single place that pays the pandas column lookup and dtype conversion, so
+    every predict/export call site shares the same layout instead of
+    re-deriving it.
+    """
+    return np.ascontiguousarray(df.loc[:, FEATURE_NAMES].to_numpy(dtype=np.float32))
+
 # Race/ethnicity coding (NHANES RIDRETH1 → integer)
 RACE_ETH_MAP = {
     1: 0,  # Mexican American
@@ -122,6 +137,13 @@ SUPPLEMENT_LABELS = [0, 1, 2, 3, 4]  # none, trace, low, moderate, high
 # Quantile levels for training
 QUANTILES = [0.05, 0.25, 0.50, 0.75, 0.95]
 
+# Per-quantile labels and model file names, computed once; scripts index
+# these instead of re-formatting f"q{int(alpha*100):02d}" in every loop
+QUANTILE_LABELS = {a: f"q{int(a * 100):02d}" for a in QUANTILES}
+LGBM_TXT_NAMES = {a: f"lgbm_{lbl}.txt" for a, lbl in QUANTILE_LABELS.items()}
+LGBM_PKL_NAMES = {a: f"lgbm_{lbl}.pkl" for a, lbl in QUANTILE_LABELS.items()}
+ONNX_NAMES = {a: f"quantile_{lbl}.onnx" for a, lbl in QUANTILE_LABELS.items()}
+
 # Model hyperparameter search space
 HYPERPARAM_GRID = {
     "num_leaves": [31, 63],